@@ -19,9 +19,51 @@ Usage:
 """
 
 import pandas as pd
+import numpy as np
 import argparse
+import functools
 import glob
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Optional xxhash for the Read_ID merge key (stdlib blake2b is the fallback).
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# pyarrow is only needed for --format parquet.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+def _hash_read_id(read_id):
+    if isinstance(read_id, str):
+        read_id = read_id.encode()
+    if xxhash is not None:
+        return xxhash.xxh64_intdigest(read_id)
+    return int.from_bytes(hashlib.blake2b(read_id, digest_size=8).digest(), 'big')
+
+def hash_read_ids(read_ids):
+    """
+    Map read IDs to uint64 hashes, matching the Read_ID_hash column written
+    by dual_guide_parsing.py.
+    """
+    return np.fromiter((_hash_read_id(read_id) for read_id in read_ids),
+                       dtype=np.uint64, count=len(read_ids))
+
+def read_csv_fast(csv_file, **kwargs):
+    """
+    pd.read_csv wrapper that selects the multi-threaded pyarrow engine when
+    pyarrow is installed. Explicit usecols/dtype arguments should be passed
+    so no column is parsed or type-inferred unnecessarily.
+    """
+    if pa is not None:
+        kwargs.setdefault('engine', 'pyarrow')
+    return pd.read_csv(csv_file, **kwargs)
 
 def merge_barcode_and_sgRNA_output(barcode_file, cluster_file, bartender_input_file):
     """
@@ -35,12 +77,15 @@ def merge_barcode_and_sgRNA_output(barcode_file, cluster_file, bartender_input_f
     Returns:
       pd.DataFrame: Merged DataFrame.
     """
-    # Load barcode data (dropping the 'Frequency' column)
-    barcode_df = pd.read_csv(barcode_file).drop(columns=['Frequency'])
-    # Load cluster data (dropping unnecessary columns)
-    cluster_df = pd.read_csv(cluster_file).drop(columns=['Cluster.Score', 'time_point_1'])
+    # Load barcode data; usecols skips the 'Frequency' column at parse time
+    barcode_df = read_csv_fast(barcode_file, usecols=['Cluster.ID', 'Unique.reads'],
+                               dtype={'Cluster.ID': 'int64', 'Unique.reads': str})
+    # Load cluster data; only the ID and Center columns are needed
+    cluster_df = read_csv_fast(cluster_file, usecols=['Cluster.ID', 'Center'],
+                               dtype={'Cluster.ID': 'int64', 'Center': str})
     # Load bartender data; no header and two columns: Clonal_barcode and Read_ID
-    bartender_df = pd.read_csv(bartender_input_file, sep=',', names=['Clonal_barcode', 'Read_ID'], header=None)
+    bartender_df = read_csv_fast(bartender_input_file, sep=',', names=['Clonal_barcode', 'Read_ID'],
+                                 header=None, dtype={'Clonal_barcode': str, 'Read_ID': str})
     
     # Merge barcode and cluster data on 'Cluster.ID'
     merged_df = pd.merge(barcode_df, cluster_df, how='inner', on='Cluster.ID')
@@ -50,12 +95,28 @@ def merge_barcode_and_sgRNA_output(barcode_file, cluster_file, bartender_input_f
     
     return merged_df
 
-def combine_sgRNA_barcode_from_same_mouse(input_folder):
+@functools.lru_cache(maxsize=None)
+def _load_sgRNA_reference(ref_path):
+    return pd.read_csv(ref_path)
+
+def load_sgRNA_reference(ref_file):
+    """
+    Load a reference sgRNA table, memoized on the file's real path so repeated
+    lookups of the same file (including through symlinks) hit the in-memory
+    copy instead of re-parsing the CSV. Each worker process keeps its own
+    cache.
+    """
+    return _load_sgRNA_reference(os.path.realpath(ref_file))
+
+def combine_sgRNA_barcode_from_same_mouse(input_folder, sgRNA_ref_df=None):
     """
     Combine sgRNA and clonal barcode information from files in a given folder.
 
     Parameters:
       input_folder (str): The path to the folder containing sample data.
+      sgRNA_ref_df (pd.DataFrame, optional): Pre-loaded reference sgRNA data.
+        When omitted, 'Intermediate_df.csv' at the input folder level is
+        loaded through the memoized loader.
 
     Returns:
       tuple: (deduplicated_raw, deduplicated_complete) DataFrames.
@@ -63,64 +124,139 @@ def combine_sgRNA_barcode_from_same_mouse(input_folder):
     # Find all cluster files within Clonal_barcode subfolders (recursive)
     pattern = '**/Clonal_barcode/*_cluster.csv'
     barcode_files = glob.glob(os.path.join(input_folder, pattern), recursive=True)
-    # The reference sgRNA data is assumed to be in 'Intermediate_df.csv' at the input folder level.
-    ref_file = os.path.join(input_folder, 'Intermediate_df.csv')
-    barcode_dataframes = []
-    
+    if sgRNA_ref_df is None:
+        # The reference sgRNA data is assumed to be in 'Intermediate_df.csv' at the input folder level.
+        ref_file = os.path.join(input_folder, 'Intermediate_df.csv')
+        sgRNA_ref_df = load_sgRNA_reference(ref_file)
+    use_hash_key = 'Read_ID_hash' in sgRNA_ref_df.columns
+
+    group_cols_raw = ['gRNA_combination', 'Clonal_barcode_center', 'gRNA1', 'gRNA2', 'Clonal_barcode', 'Sample_ID']
+    deduplicated_raw = None
+
+    # Each file is merged with the reference and reduced to per-group counts
+    # immediately, and the partial counts are sum-reduced into the running
+    # aggregate. Peak memory stays at one merged file plus the (much smaller)
+    # aggregate instead of the concatenation of every file.
     for cluster_file in barcode_files:
         # Construct paths for the barcode and bartender files
         barcode_file = cluster_file.replace('cluster', 'barcode')
         bartender_input_file = cluster_file.replace('_cluster.csv', '.bartender')
-        
-        # Merge data from the three files
         merged_df = merge_barcode_and_sgRNA_output(barcode_file, cluster_file, bartender_input_file)
-        barcode_dataframes.append(merged_df)
-    
-    # Combine data from all files into one DataFrame
-    combined_df = pd.concat(barcode_dataframes).reset_index(drop=True)
-    sgRNA_ref_df = pd.read_csv(ref_file)
-    final_df = combined_df.merge(sgRNA_ref_df, on=['Read_ID', 'Clonal_barcode'])
-    
-    # Deduplicate data with two grouping strategies
-    group_cols_raw = ['gRNA_combination', 'Clonal_barcode_center', 'gRNA1', 'gRNA2', 'Clonal_barcode', 'Sample_ID']
-    deduplicated_raw = final_df.groupby(group_cols_raw, as_index=False)['Read_ID'].count()
-    deduplicated_raw.rename(columns={'Read_ID': 'Frequency'}, inplace=True)
-    
+
+        if use_hash_key:
+            # Join on the 8-byte Read_ID hash written by the parsing step
+            # instead of the full header string; integer merge keys hash and
+            # compare much faster than long strings.
+            merged_df['Read_ID_hash'] = hash_read_ids(merged_df['Read_ID'])
+            file_df = merged_df.merge(sgRNA_ref_df.drop(columns=['Read_ID']),
+                                      on=['Read_ID_hash', 'Clonal_barcode'])
+        else:
+            # Older intermediate files without the hash column.
+            file_df = merged_df.merge(sgRNA_ref_df, on=['Read_ID', 'Clonal_barcode'])
+
+        # The group keys are low-cardinality strings relative to the number
+        # of rows; as categories the groupby hashes integer codes instead of
+        # string objects and the columns take a fraction of the memory.
+        for column in group_cols_raw:
+            file_df[column] = file_df[column].astype('category')
+
+        partial = file_df.groupby(group_cols_raw, as_index=False, sort=False, observed=True)['Read_ID'].count()
+        partial.rename(columns={'Read_ID': 'Frequency'}, inplace=True)
+        if deduplicated_raw is None:
+            deduplicated_raw = partial
+        else:
+            deduplicated_raw = pd.concat([deduplicated_raw, partial]).groupby(
+                group_cols_raw, as_index=False, sort=False, observed=True)['Frequency'].sum()
+
+    # Deduplicate with the second, coarser grouping. Its keys are a strict
+    # subset of the raw grouping keys, so it is derived from the already
+    # reduced raw table; sort=False skips the unused post-groupby sort.
+
     group_cols_complete = ['gRNA_combination', 'Clonal_barcode_center', 'gRNA1', 'gRNA2', 'Sample_ID']
-    deduplicated_complete = final_df.groupby(group_cols_complete, as_index=False)['Read_ID'].count()
-    deduplicated_complete.rename(columns={'Read_ID': 'Frequency', 'Clonal_barcode_center': 'Clonal_barcode'}, inplace=True)
+    deduplicated_complete = deduplicated_raw.groupby(group_cols_complete, as_index=False, sort=False, observed=True)['Frequency'].sum()
+    deduplicated_complete.rename(columns={'Clonal_barcode_center': 'Clonal_barcode'}, inplace=True)
     
     return deduplicated_raw, deduplicated_complete
 
+def write_output(df, output_file, output_format):
+    """Write a DataFrame as CSV or snappy-compressed Parquet."""
+    if output_format == 'parquet':
+        df.to_parquet(output_file, compression='snappy', index=False)
+    else:
+        df.to_csv(output_file, index=False)
+
+def read_output(output_file, output_format):
+    """Read back a file written by write_output."""
+    if output_format == 'parquet':
+        return pd.read_parquet(output_file)
+    return pd.read_csv(output_file)
+
+def process_sample(subfolder, output_prefix, output_format='csv'):
+    """
+    Process one sample folder and write its two per-sample output files.
+
+    Parameters:
+      subfolder (str): Path of the sample folder.
+      output_prefix (str): Prefix for output files.
+      output_format (str): 'csv' or 'parquet'.
+
+    Returns:
+      str: Path of the deduplicated output file, so the parent process can
+      re-read it for the combined file instead of pickling large DataFrames.
+    """
+    sample_id = os.path.basename(subfolder)
+    output_file1 = f"{output_prefix}{sample_id}/Combined_ND_df.{output_format}"
+    output_file2 = f"{output_prefix}{sample_id}/Combined_deduplexed_df.{output_format}"
+    df1, df2 = combine_sgRNA_barcode_from_same_mouse(subfolder)
+    # Ensure output directories exist
+    os.makedirs(os.path.dirname(output_file1), exist_ok=True)
+    os.makedirs(os.path.dirname(output_file2), exist_ok=True)
+    write_output(df1, output_file1, output_format)
+    write_output(df2, output_file2, output_format)
+    return output_file2
+
 def main():
     parser = argparse.ArgumentParser(description='Combine sgRNA and clonal barcode information')
     parser.add_argument("--a", required=True, help="Input bartender folder containing sample subdirectories")
     parser.add_argument("--o", required=True, help="Prefix for output files")
+    # Parquet (dictionary-encoded columnar binary, needs pyarrow) writes and
+    # reads far faster than CSV; CSV stays the default for backward compat.
+    parser.add_argument("--format", default='csv', choices=['csv', 'parquet'],
+                        help="Output file format (default: csv)")
     args = parser.parse_args()
 
     output_prefix = args.o
     input_folder = args.a
+    output_format = args.format
     # Get a list of subfolders (each corresponding to a sample/mouse)
     subfolders = [os.path.join(input_folder, name) for name in os.listdir(input_folder) 
                   if os.path.isdir(os.path.join(input_folder, name))]
-    final_dataframes = []
-
-    for subfolder in subfolders:
-        sample_id = os.path.basename(subfolder)
-        output_file1 = f"{output_prefix}{sample_id}/Combined_ND_df.csv"
-        output_file2 = f"{output_prefix}{sample_id}/Combined_deduplexed_df.csv"
-        df1, df2 = combine_sgRNA_barcode_from_same_mouse(subfolder)
-        # Ensure output directories exist
-        os.makedirs(os.path.dirname(output_file1), exist_ok=True)
-        os.makedirs(os.path.dirname(output_file2), exist_ok=True)
-        df1.to_csv(output_file1, index=False)
-        df2.to_csv(output_file2, index=False)
-        
-        final_dataframes.append(df2)
-    
-    # Combine deduplicated data from all samples into one file
-    final_combined_df = pd.concat(final_dataframes)
-    final_combined_df.to_csv(f"{output_prefix}gRNA_clonalbarcode_combined.csv", index=False)
+    # Each sample reads and writes its own set of files, so the samples are
+    # processed in parallel across worker processes.
+    combined_file = f"{output_prefix}gRNA_clonalbarcode_combined.{output_format}"
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(process_sample, subfolder, output_prefix, output_format)
+                   for subfolder in subfolders]
+        # Append each sample's deduplicated table to the combined file as it
+        # completes, so peak memory is one sample's table rather than a
+        # concat of all of them.
+        parquet_writer = None
+        first_sample = True
+        for future in as_completed(futures):
+            sample_df = read_output(future.result(), output_format)
+            if output_format == 'parquet':
+                table = pa.Table.from_pandas(sample_df, preserve_index=False)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(combined_file, table.schema, compression='snappy')
+                else:
+                    table = table.cast(parquet_writer.schema)
+                parquet_writer.write_table(table)
+            else:
+                sample_df.to_csv(combined_file, mode='w' if first_sample else 'a',
+                                 header=first_sample, index=False)
+            first_sample = False
+        if parquet_writer is not None:
+            parquet_writer.close()
 
 if __name__ == "__main__":
     main()
@@ -19,22 +19,440 @@ Input:
     
 """
 
+import bisect
 import gzip
-import regex
+import hashlib
 import argparse
+import numpy as np
 import pandas as pd
 
-def find_reverse_complementary(input_string):
+# Optional accelerated gzip backends. xopen delegates to pigz/igzip for
+# multi-threaded decompression; isal provides SIMD (ISA-L) DEFLATE. Both are
+# drop-in replacements for gzip and plain gzip remains the fallback.
+try:
+    from xopen import xopen
+except ImportError:
+    xopen = None
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+# Optional Hyperscan backend: compiles the anchor motifs into a SIMD DFA that
+# scans a whole batch of sequences in one pass.
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+# Optional dnaio backend: paired FASTQ parsing in Cython on top of isal.
+try:
+    import dnaio
+except ImportError:
+    dnaio = None
+# Optional Numba backend for the classification kernel.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+# Optional xxhash for the Read_ID merge key (stdlib blake2b is the fallback).
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+def _hash_read_id(read_id):
+    if isinstance(read_id, str):
+        read_id = read_id.encode()
+    if xxhash is not None:
+        return xxhash.xxh64_intdigest(read_id)
+    return int.from_bytes(hashlib.blake2b(read_id, digest_size=8).digest(), 'big')
+
+def hash_read_ids(read_ids):
+    """
+    Map read IDs (str or bytes) to uint64 hashes. The hash column serves as a
+    compact deterministic merge key downstream, where joining on 8-byte
+    integers is much cheaper than on the full FASTQ header strings.
+    """
+    return np.fromiter((_hash_read_id(read_id) for read_id in read_ids),
+                       dtype=np.uint64, count=len(read_ids))
+
+# 2-bit codes for the four bases (upper and lower case byte values).
+_BASE_CODES = {65: 0, 67: 1, 71: 2, 84: 3, 97: 0, 99: 1, 103: 2, 116: 3}
+
+def encode_gRNA(seq):
+    """
+    Pack a gRNA (bytes, up to 21 bp) into an integer: 2 bits per base behind
+    a leading marker bit, so sequences of different lengths cannot collide.
+    Returns 0 for sequences containing non-ACGT characters, which can never
+    match the reference.
+    """
+    code = 1
+    for base in seq:
+        value = _BASE_CODES.get(base)
+        if value is None:
+            return 0
+        code = (code << 2) | value
+    return code
+
+# Mask selecting the low bit of every 2-bit base in a packed code. After
+# XORing two codes, (x | x >> 1) & mask leaves one bit per mismatched base,
+# so a popcount gives the Hamming distance of equal-length sequences.
+_PAYLOAD_MASK01 = np.uint64(sum(1 << (2 * k) for k in range(21)))
+
+def _popcount_u64(arr):
+    """Vectorized 64-bit popcount (SWAR)."""
+    m1 = np.uint64(0x5555555555555555)
+    m2 = np.uint64(0x3333333333333333)
+    m4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+    x = arr - ((arr >> np.uint64(1)) & m1)
+    x = (x & m2) + ((x >> np.uint64(2)) & m2)
+    x = (x + (x >> np.uint64(4))) & m4
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _isin_sorted(codes, reference):
+        out = np.empty(codes.size, dtype=np.bool_)
+        for i in prange(codes.size):
+            j = np.searchsorted(reference, codes[i])
+            out[i] = j < reference.size and reference[j] == codes[i]
+        return out
+
+    @njit(parallel=True, cache=True)
+    def _isin_mismatch(codes, reference, max_mismatch):
+        out = np.empty(codes.size, dtype=np.bool_)
+        for i in prange(codes.size):
+            hit = False
+            if codes[i] != 0:
+                for j in range(reference.size):
+                    x = codes[i] ^ reference[j]
+                    # Equal-length codes cancel their marker bits, so the XOR
+                    # is smaller than either code; otherwise lengths differ
+                    # and Hamming distance is undefined.
+                    if x >= codes[i] or x >= reference[j]:
+                        continue
+                    x = (x | (x >> np.uint64(1))) & _PAYLOAD_MASK01
+                    n_mismatch = 0
+                    while x:
+                        x &= x - np.uint64(1)
+                        n_mismatch += 1
+                    if n_mismatch <= max_mismatch:
+                        hit = True
+                        break
+            out[i] = hit
+        return out
+else:
+    def _isin_sorted(codes, reference):
+        if reference.size == 0:
+            return np.zeros(codes.size, dtype=np.bool_)
+        positions = np.searchsorted(reference, codes)
+        positions[positions == reference.size] = reference.size - 1
+        return reference[positions] == codes
+
+    def _isin_mismatch(codes, reference, max_mismatch):
+        out = np.zeros(codes.size, dtype=np.bool_)
+        # The reference library is small (thousands), so loop over it and
+        # compare all read codes against each entry in one vectorized pass.
+        for ref_code in reference:
+            x = codes ^ ref_code
+            # Marker bits only cancel for equal-length codes, in which case
+            # the XOR is smaller than either code; otherwise lengths differ
+            # and Hamming distance is undefined.
+            same_length = (x < codes) & (x < ref_code)
+            x = (x | (x >> np.uint64(1))) & _PAYLOAD_MASK01
+            out |= same_length & (_popcount_u64(x) <= max_mismatch)
+        return out & (codes != 0)
+
+def classify_expected(codes1, codes2, reference1, reference2, max_mismatch=0):
+    """
+    Return a boolean array marking reads whose encoded gRNA pair is present
+    in both reference code arrays. Exact matching (the default) is a binary
+    search per code; with max_mismatch > 0 a read gRNA also matches any
+    equal-length reference within that Hamming distance, computed as
+    XOR + popcount on the packed codes. Runs as parallel Numba kernels when
+    numba is installed, otherwise vectorized with NumPy.
+    """
+    if max_mismatch > 0:
+        return (_isin_mismatch(codes1, reference1, max_mismatch)
+                & _isin_mismatch(codes2, reference2, max_mismatch))
+    return _isin_sorted(codes1, reference1) & _isin_sorted(codes2, reference2)
+
+def encode_reference_gRNAs(sequences):
+    """Encode an iterable of reference gRNA strings into a sorted code array."""
+    codes = np.fromiter((encode_gRNA(s.encode()) for s in sequences), dtype=np.uint64)
+    return np.sort(codes[codes != 0])
+
+# The construct layouts are fixed-width apart from the 16-21 bp gRNA, so the
+# anchors can be located with bytes.find/rfind (C substring search) and the
+# fields sliced at constant offsets -- no general regex engine needed.
+# R1 layout: TAGTT | 16 bp barcode | TATGG | 16-21 bp gRNA1 | GTTTA.
+# R2 is searched in raw orientation for the reverse complement of the motif
+# TGTTG | 16-21 bp gRNA2 | GTTTG, i.e. CAAAC | gRNA2' | CAACA.
+
+def parse_read1(seq):
+    """
+    Return (clonal_barcode, gRNA1) from an R1 sequence, or None if the
+    anchors are not found. Equivalent to the former regex pattern
+    TAGTT(.{16})TATGG(.{16,21})GTTTA with leftmost/greedy semantics.
+    """
+    i = seq.find(b'TAGTT')
+    while i >= 0:
+        if seq[i + 21:i + 26] == b'TATGG':
+            # GTTTA must start 16-21 bp after the TATGG anchor; rfind keeps
+            # the greedy (longest gRNA) behaviour of the regex.
+            j = seq.rfind(b'GTTTA', i + 42, i + 52)
+            if j >= 0:
+                return seq[i + 5:i + 21], seq[i + 26:j]
+        i = seq.find(b'TAGTT', i + 1)
+    return None
+
+def parse_read2(seq):
+    """
+    Return gRNA2 (still reverse complemented) from a raw R2 sequence, or
+    None if the anchors are not found. The scan runs right to left so the
+    result mirrors exactly what searching TGTTG(.{16,21})GTTTG on the
+    reverse-complemented read used to yield: leftmost TGTTG there is the
+    rightmost CAACA here, and the greedy (longest) capture corresponds to
+    the leftmost CAAAC within the 16-21 bp window.
+    """
+    j = seq.rfind(b'CAACA')
+    # Any valid CAACA must leave room for CAAAC plus a 16 bp gap before it.
+    while j >= 21:
+        i = seq.find(b'CAAAC', max(j - 26, 0), j - 16)
+        if i >= 0:
+            return seq[i + 5:j]
+        j = seq.rfind(b'CAACA', 0, j + 4)
+    return None
+
+def _build_hs_database(expression):
+    """Compile a single-pattern Hyperscan database with start-of-match info."""
+    db = hyperscan.Database()
+    db.compile(expressions=[expression], ids=[0], flags=[hyperscan.HS_FLAG_SOM_LEFTMOST])
+    return db
+
+if hyperscan is not None:
+    _HS_DB1 = _build_hs_database(b'TAGTT.{16}TATGG.{16,21}GTTTA')
+    _HS_DB2 = _build_hs_database(b'CAAAC.{16,21}CAACA')
+else:
+    _HS_DB1 = _HS_DB2 = None
+
+def _scan_batch(db, sequences, rightmost=False):
+    """
+    Scan a batch of sequences through a Hyperscan database in one pass and
+    return the (start, end) span of the match within each sequence, or None
+    for sequences that do not match. The sequences are joined with newlines,
+    which the patterns cannot cross, and the match offsets are mapped back to
+    their record by bisecting on the joined offsets. With rightmost=True the
+    rightmost (then longest) match is kept instead of the leftmost, for
+    patterns that are scanned in reverse-complement orientation.
+    """
+    starts = [0]
+    for seq in sequences:
+        starts.append(starts[-1] + len(seq) + 1)
+    spans = [None] * len(sequences)
+
+    def on_match(match_id, start, end, flags, context):
+        index = bisect.bisect_right(starts, start) - 1
+        span = (start - starts[index], end - starts[index])
+        if rightmost:
+            key = (-span[1], span[0])
+            best = None if spans[index] is None else (-spans[index][1], spans[index][0])
+        else:
+            # Mirror regex semantics: leftmost match start, then greedy length.
+            key = (span[0], -span[1])
+            best = None if spans[index] is None else (spans[index][0], -spans[index][1])
+        if best is None or key < best:
+            spans[index] = span
+
+    db.scan(b'\n'.join(sequences), match_event_handler=on_match)
+    return spans
+
+def extract_read1_batch(sequences):
+    """
+    Extract (clonal_barcode, gRNA1) from each R1 sequence of a batch,
+    returning None for sequences without the expected anchors. With Hyperscan
+    the anchor widths are fixed, so the fields are sliced from the match span
+    at known offsets instead of using capture groups.
+    """
+    if _HS_DB1 is not None:
+        fields = []
+        for seq, span in zip(sequences, _scan_batch(_HS_DB1, sequences)):
+            if span is None:
+                fields.append(None)
+            else:
+                # Layout: TAGTT | 16 bp barcode | TATGG | 16-21 bp gRNA | GTTTA
+                fields.append((seq[span[0] + 5:span[0] + 21], seq[span[0] + 26:span[1] - 5]))
+        return fields
+    return [parse_read1(seq) for seq in sequences]
+
+def extract_read2_batch(sequences):
+    """
+    Extract gRNA2 from each raw R2 sequence of a batch, returning None for
+    sequences without the expected anchors. The pattern is already reverse
+    complemented, so only the matched 16-21 bp group is flipped back to the
+    construct orientation rather than the whole 150 bp read.
+    """
+    if _HS_DB2 is not None:
+        return [
+            find_reverse_complementary(seq[span[0] + 5:span[1] - 5]) if span else None
+            for seq, span in zip(sequences, _scan_batch(_HS_DB2, sequences, rightmost=True))
+        ]
+    return [
+        find_reverse_complementary(gRNA2) if gRNA2 is not None else None
+        for gRNA2 in (parse_read2(seq) for seq in sequences)
+    ]
+
+def open_fastq(fastqgz_address):
     """
-    Returns the reverse complementary sequence of the given DNA string.
+    Open a gzipped FASTQ file for binary reading, preferring the fastest
+    available decompression backend (xopen > igzip > gzip).
+    """
+    if xopen is not None:
+        return xopen(fastqgz_address, 'rb', threads=4)
+    if igzip is not None:
+        return igzip.open(fastqgz_address, 'rb')
+    return gzip.open(fastqgz_address, 'rb')
+
+# Translation table for complementing DNA bytes (upper and lower case).
+_RC_TABLE = bytes.maketrans(b'ACGTNacgtn', b'TGCANtgcan')
+
+# Amount of decompressed data pulled from a FASTQ stream per read() call.
+_CHUNK_SIZE = 64 << 20
+
+def iter_read_batches(handler, chunk_size=_CHUNK_SIZE):
+    """
+    Yield (read_ids, sequences) lists parsed from ~chunk_size byte chunks of
+    a binary FASTQ stream. Newlines are located with one vectorized (SIMD)
+    compare over the whole chunk -- the NumPy equivalent of memchr -- and
+    only the ID and sequence lines are sliced out; '+' and quality lines are
+    never materialized.
+    """
+    leftover = b''
+    phase = 0  # line index within the current 4-line record
+    ids, seqs = [], []
+    while True:
+        chunk = handler.read(chunk_size)
+        if not chunk:
+            break
+        buf = leftover + chunk
+        newline_positions = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 0x0A)
+        n_lines = newline_positions.size
+        if n_lines == 0:
+            leftover = buf
+            continue
+        line_starts = np.empty(n_lines, dtype=np.int64)
+        line_starts[0] = 0
+        line_starts[1:] = newline_positions[:-1] + 1
+        line_phases = (np.arange(n_lines) + phase) % 4
+        for row in np.flatnonzero(line_phases == 0):
+            ids.append(buf[line_starts[row]:newline_positions[row]])
+        for row in np.flatnonzero(line_phases == 1):
+            seqs.append(buf[line_starts[row]:newline_positions[row]])
+        leftover = buf[newline_positions[-1] + 1:]
+        phase = (phase + n_lines) % 4
+        n_pairs = min(len(ids), len(seqs))
+        if n_pairs:
+            yield ids[:n_pairs], seqs[:n_pairs]
+            del ids[:n_pairs], seqs[:n_pairs]
+    # A final line without trailing newline can still be an ID or a sequence.
+    if leftover:
+        if phase % 4 == 0:
+            ids.append(leftover)
+        elif phase % 4 == 1:
+            seqs.append(leftover)
+    n_pairs = min(len(ids), len(seqs))
+    if n_pairs:
+        yield ids[:n_pairs], seqs[:n_pairs]
+
+def iter_paired_batches(handler1, handler2, chunk_size=_CHUNK_SIZE):
+    """
+    Yield equal-length (read_ids, sequences1, sequences2) batches from two
+    FASTQ streams. Because R1 and R2 lines differ in length, the chunk
+    boundaries of the two files do not line up record-for-record, so batches
+    are buffered and re-cut to the same size before being yielded.
+    """
+    gen1 = iter_read_batches(handler1, chunk_size)
+    gen2 = iter_read_batches(handler2, chunk_size)
+    ids1, seqs1, seqs2 = [], [], []
+    done1 = done2 = False
+    while True:
+        while not done1 and len(seqs1) <= len(seqs2):
+            try:
+                batch_ids, batch_seqs = next(gen1)
+            except StopIteration:
+                done1 = True
+            else:
+                ids1.extend(batch_ids)
+                seqs1.extend(batch_seqs)
+        while not done2 and len(seqs2) < len(seqs1):
+            try:
+                _, batch_seqs = next(gen2)
+            except StopIteration:
+                done2 = True
+            else:
+                seqs2.extend(batch_seqs)
+        n_paired = min(len(seqs1), len(seqs2))
+        if n_paired == 0:
+            break
+        yield ids1[:n_paired], seqs1[:n_paired], seqs2[:n_paired]
+        del ids1[:n_paired], seqs1[:n_paired], seqs2[:n_paired]
+
+# Number of records per batch when reading through dnaio.
+_DNAIO_BATCH_SIZE = 1 << 20
+
+def iter_paired_batches_dnaio(fastqgz_address1, fastqgz_address2, batch_size=_DNAIO_BATCH_SIZE):
+    """
+    Yield (read_ids, sequences1, sequences2) batches through dnaio's paired
+    FASTQ reader, which parses records in Cython and decompresses with isal.
+    Records are re-encoded to bytes to match iter_paired_batches, including
+    the '@' prefix that dnaio strips from the header line.
+    """
+    ids1, seqs1, seqs2 = [], [], []
+    with dnaio.open(fastqgz_address1, file2=fastqgz_address2, mode='r') as reader:
+        for record1, record2 in reader:
+            ids1.append(('@' + record1.name).encode())
+            seqs1.append(record1.sequence.encode())
+            seqs2.append(record2.sequence.encode())
+            if len(ids1) >= batch_size:
+                yield ids1, seqs1, seqs2
+                ids1, seqs1, seqs2 = [], [], []
+    if ids1:
+        yield ids1, seqs1, seqs2
+
+def iter_paired_batches_from_files(fastqgz_address1, fastqgz_address2):
+    """
+    Open a pair of FASTQ gz files and yield paired batches, preferring the
+    dnaio reader when the package is installed.
+    """
+    if dnaio is not None:
+        yield from iter_paired_batches_dnaio(fastqgz_address1, fastqgz_address2)
+        return
+    with open_fastq(fastqgz_address1) as handler1, open_fastq(fastqgz_address2) as handler2:
+        yield from iter_paired_batches(handler1, handler2)
+
+def find_reverse_complementary(input_bytes):
+    """
+    Returns the reverse complementary sequence of the given DNA bytes.
     Supports uppercase and lowercase letters.
     """
-    temp_dic = {
-        'A': 'T', 'G': 'C', 'T': 'A', 'C': 'G', 'N': 'N',
-        'a': 't', 'g': 'c', 't': 'a', 'c': 'g', 'n': 'n'
-    }
-    # Reverse the string and convert each base using the dictionary
-    return ''.join(temp_dic.get(x, x) for x in input_string[::-1])
+    # bytes.translate runs the whole lookup in C, then reverse the result
+    return input_bytes.translate(_RC_TABLE)[::-1]
+
+def build_output_df(gRNA1_arr, gRNA2_arr, barcode_arr, read_id_arr, sample_id, read_class):
+    """
+    Assemble an output DataFrame from fixed-width byte arrays. Each column is
+    decoded to str in a single vectorized astype call.
+    """
+    df = pd.DataFrame({
+        'gRNA1': gRNA1_arr.astype(str),
+        'gRNA2': gRNA2_arr.astype(str),
+        'Clonal_barcode': barcode_arr.astype(str),
+        'Read_ID': read_id_arr.astype(str),
+        'Read_ID_hash': hash_read_ids(read_id_arr),
+        'Sample_ID': sample_id,
+        'Class': read_class
+    })
+    df['gRNA_combination'] = df['gRNA1'] + '_' + df['gRNA2']
+    return df
 
 def main():
     parser = argparse.ArgumentParser(
@@ -44,6 +462,9 @@ def main():
     parser.add_argument("--a2", required=True, help="Input FASTQ gz file R2")
     parser.add_argument("--b", required=True, help="Input CSV file of reference sgRNA")
     parser.add_argument("--o", required=True, help="Output directory")
+    parser.add_argument("--mm", type=int, default=0,
+                        help="Maximum Hamming distance allowed when matching extracted gRNAs "
+                             "against the reference (default: 0, exact match only)")
     args = parser.parse_args()
     
     fastqgz_input_address1 = args.a1
@@ -51,16 +472,12 @@ def main():
     ref_address = args.b
     output_dir = args.o
     
-    # Load reference sgRNA data
+    # Load reference sgRNA data as sorted arrays of 2-bit packed codes, so a
+    # whole batch of reads is classified with binary searches over integers
+    # instead of per-read string set lookups.
     ref_sgRNA_df = pd.read_csv(ref_address)
-    gRNA1_list = ref_sgRNA_df[ref_sgRNA_df.Position == 'G1']['gRNA_complete'].to_list()
-    gRNA2_list = ref_sgRNA_df[ref_sgRNA_df.Position == 'G2']['gRNA_complete'].to_list()
-    
-    # Compile regex patterns for sequence extraction
-    # Pattern for read1: Extract a 16 bp barcode and a sgRNA (16-21 bp) between fixed sequence markers.
-    temp_pattern1 = regex.compile('TAGTT(.{16})TATGG(.{16,21})GTTTA')
-    # Pattern for read2: Extract a sgRNA (16-21 bp) from the reverse complemented read.
-    temp_pattern2 = regex.compile('TGTTG(.{16,21})GTTTG')
+    gRNA1_ref = encode_reference_gRNAs(ref_sgRNA_df[ref_sgRNA_df.Position == 'G1']['gRNA_complete'])
+    gRNA2_ref = encode_reference_gRNAs(ref_sgRNA_df[ref_sgRNA_df.Position == 'G2']['gRNA_complete'])
     
     # Initialize counters and lists for collecting output data.
     total_reads = 0
@@ -68,86 +485,101 @@ def main():
     matched_reads = 0
     sample_id = output_dir.split('/')[-1]  # Use the last part of output directory as sample ID
     
-    gRNA1_list_out, gRNA2_list_out = [], []
-    read_id_list, clonal_barcode_list, label_list = [], [], []
-    
-    with gzip.open(fastqgz_input_address1, 'rt') as handler1, gzip.open(fastqgz_input_address2, 'rt') as handler2:
-        # Read the first record from both files.
-        read_id = handler1.readline().rstrip()  # R1 ID
-        handler2.readline().rstrip()            # R2 ID (not used)
-        seq1 = handler1.readline().rstrip()     # R1 sequence
-        seq2 = find_reverse_complementary(handler2.readline().rstrip())  # R2 sequence (reverse complemented)
-        handler1.readline()  # skip '+'
-        handler1.readline()  # skip quality
-        handler2.readline()  # skip '+'
-        handler2.readline()  # skip quality
-        
-        while read_id:
-            total_reads += 1
-            
-            # Apply regex patterns to extract data.
-            match1 = temp_pattern1.search(seq1)
-            match2 = temp_pattern2.search(seq2)
-            if match1 and match2:
+    # Extracted fields are accumulated as fixed-width byte arrays per batch
+    # (gRNAs are at most 21 bp, barcodes exactly 16 bp), which avoids one
+    # Python str object per field and materializes the final DataFrame from
+    # plain NumPy columns. Only Expected reads are accumulated; Unexpected
+    # reads are appended to their output file batch by batch, so they never
+    # occupy memory beyond the current batch.
+    gRNA1_arrays, gRNA2_arrays, barcode_arrays, read_id_arrays = [], [], [], []
+    unexpected_file = f"{output_dir}/Unexpected_reads.csv"
+    unexpected_header_written = False
+
+    for batch_ids, batch_seq1, batch_seq2 in iter_paired_batches_from_files(
+            fastqgz_input_address1, fastqgz_input_address2):
+        total_reads += len(batch_ids)
+
+        # Extract barcode/gRNA fields from the whole batch at once.
+        fields1 = extract_read1_batch(batch_seq1)
+        fields2 = extract_read2_batch(batch_seq2)
+
+        gRNA1_arr = np.empty(len(batch_ids), dtype='S21')
+        gRNA2_arr = np.empty(len(batch_ids), dtype='S21')
+        barcode_arr = np.empty(len(batch_ids), dtype='S16')
+        code1_arr = np.empty(len(batch_ids), dtype=np.uint64)
+        code2_arr = np.empty(len(batch_ids), dtype=np.uint64)
+        kept_read_ids = []
+        n_kept = 0
+        for read_id, field1, field2 in zip(batch_ids, fields1, fields2):
+            if field1 and field2:
                 extracted_reads += 1
-                clonal_barcode = match1.group(1)
-                gRNA1 = match1.group(2)
-                gRNA2 = match2.group(1)
-                gRNA1_list_out.append(gRNA1)
-                gRNA2_list_out.append(gRNA2)
-                read_id_list.append(read_id)
-                clonal_barcode_list.append(clonal_barcode)
-                
-                # Classify the read as 'Expected' if both sgRNAs match the reference.
-                if (gRNA1 in gRNA1_list) and (gRNA2 in gRNA2_list):
-                    matched_reads += 1
-                    label_list.append('Expected')
-                else:
-                    label_list.append('Unexpected')
-            
-            # Read next record from both FASTQ files.
-            read_id = handler1.readline().rstrip()  # R1 ID
-            handler2.readline().rstrip()            # R2 ID (not used)
-            seq1 = handler1.readline().rstrip()       # R1 sequence
-            seq2 = find_reverse_complementary(handler2.readline().rstrip())  # R2 sequence (reverse complemented)
-            handler1.readline()  # skip '+'
-            handler1.readline()  # skip quality
-            handler2.readline()  # skip '+'
-            handler2.readline()  # skip quality
-            
+                barcode_arr[n_kept] = field1[0]
+                gRNA1_arr[n_kept] = field1[1]
+                gRNA2_arr[n_kept] = field2
+                code1_arr[n_kept] = encode_gRNA(field1[1])
+                code2_arr[n_kept] = encode_gRNA(field2)
+                kept_read_ids.append(read_id)
+                n_kept += 1
+        if n_kept:
+            # Classify the batch: a read is 'Expected' if both packed gRNA
+            # codes are found in the reference arrays.
+            expected_mask = classify_expected(code1_arr[:n_kept], code2_arr[:n_kept],
+                                              gRNA1_ref, gRNA2_ref, args.mm)
+            matched_reads += int(expected_mask.sum())
+            read_id_arr = np.array(kept_read_ids)
+            if not expected_mask.all():
+                unexpected_df = build_output_df(gRNA1_arr[:n_kept][~expected_mask],
+                                                gRNA2_arr[:n_kept][~expected_mask],
+                                                barcode_arr[:n_kept][~expected_mask],
+                                                read_id_arr[~expected_mask],
+                                                sample_id, 'Unexpected')
+                unexpected_df.to_csv(unexpected_file, mode='a' if unexpected_header_written else 'w',
+                                     header=not unexpected_header_written, index=False)
+                unexpected_header_written = True
+            if expected_mask.any():
+                gRNA1_arrays.append(gRNA1_arr[:n_kept][expected_mask])
+                gRNA2_arrays.append(gRNA2_arr[:n_kept][expected_mask])
+                barcode_arrays.append(barcode_arr[:n_kept][expected_mask])
+                read_id_arrays.append(read_id_arr[expected_mask])
+
     # Print a summary of the processing.
     print(f"Sample {sample_id} has a total of {total_reads} reads. "
           f"{extracted_reads} reads ({extracted_reads/total_reads:.3f}) have barcode and sgRNA. "
           f"{matched_reads} reads ({matched_reads/total_reads:.3f}) have expected sgRNA.")
     
-    # Create a DataFrame with the extraction results.
-    Final_df = pd.DataFrame({
-        'gRNA1': gRNA1_list_out,
-        'gRNA2': gRNA2_list_out,
-        'Clonal_barcode': clonal_barcode_list,
-        'Read_ID': read_id_list,
-        'Sample_ID': sample_id,
-        'Class': label_list
-    })
-    Final_df['gRNA_combination'] = Final_df['gRNA1'] + '_' + Final_df['gRNA2']
-    
-    # Write out Unexpected reads.
-    unexpected_file = f"{output_dir}/Unexpected_reads.csv"
-    Final_df[Final_df.Class == 'Unexpected'].to_csv(unexpected_file, index=False)
-    
+    # Build the Expected-read DataFrame; Unexpected reads were streamed out
+    # during the main loop.
+    empty = np.empty(0, dtype='S1')
+    Final_df = build_output_df(
+        np.concatenate(gRNA1_arrays) if gRNA1_arrays else empty,
+        np.concatenate(gRNA2_arrays) if gRNA2_arrays else empty,
+        np.concatenate(barcode_arrays) if barcode_arrays else empty,
+        np.concatenate(read_id_arrays) if read_id_arrays else empty,
+        sample_id, 'Expected')
+    if not unexpected_header_written:
+        # No Unexpected reads; still leave a header-only file behind.
+        build_output_df(empty, empty, empty, empty, sample_id,
+                        'Unexpected').to_csv(unexpected_file, index=False)
+
     # Write out Expected reads to an intermediate file.
     intermediate_file = f"{output_dir}/Intermediate_df.csv"
-    Final_df[Final_df.Class != 'Unexpected'].to_csv(intermediate_file, index=False)
-    
-    # Group expected reads by gRNA combination and create files for downstream processing.
-    expected_df = Final_df[Final_df.Class != 'Unexpected']
-    sgRNA_groups = expected_df.groupby("gRNA_combination")
+    Final_df.to_csv(intermediate_file, index=False)
+
+    # Group expected reads by gRNA combination and create files for downstream
+    # processing. The bartender lines are formatted in one vectorized string
+    # operation and each group is written as a contiguous slice of that array,
+    # instead of paying the to_csv setup cost once per (often tiny) group.
+    expected_df = Final_df.sort_values('gRNA_combination', kind='stable')
+    bartender_lines = (expected_df['Clonal_barcode'] + ',' + expected_df['Read_ID'] + '\n').to_numpy()
+    group_names, group_starts = np.unique(expected_df['gRNA_combination'].to_numpy(), return_index=True)
+    group_ends = np.append(group_starts[1:], len(bartender_lines))
     bartender_input_file = f"{output_dir}/Bartender_input_address"
     with open(bartender_input_file, 'w') as file_a:
-        for group_name, group_df in sgRNA_groups:
+        for group_name, start, end in zip(group_names, group_starts, group_ends):
             out_filename = f"{output_dir}/Clonal_barcode/{group_name}.bartender"
             file_a.write(out_filename + '\n')
-            group_df[['Clonal_barcode', 'Read_ID']].to_csv(out_filename, sep=',', header=False, index=False)
+            with open(out_filename, 'w') as file_b:
+                file_b.writelines(bartender_lines[start:end])
 
 if __name__ == "__main__":
     main()